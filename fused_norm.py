@@ -0,0 +1,106 @@
+import torch
+import torch.nn.functional as F
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+@torch.library.custom_op("paella::modulated_layer_norm", mutates_args=())
+def _modulated_layer_norm(
+    x: torch.Tensor,
+    w: torch.Tensor,
+    ln_weight: torch.Tensor,
+    ln_bias: torch.Tensor,
+    gamma: torch.Tensor,
+    beta: torch.Tensor,
+    eps: float,
+    rows_per_w: int,
+) -> torch.Tensor:
+    '''
+    Reference implementation of `gamma * w * layer_norm(x) + beta * w` for
+    x of shape [N, C] and w of shape [N // rows_per_w, C].
+    '''
+    x = F.layer_norm(x, x.shape[-1:], ln_weight, ln_bias, eps)
+    w = w.repeat_interleave(rows_per_w, dim=0)
+    return gamma * w * x + beta * w
+
+
+@_modulated_layer_norm.register_fake
+def _(x, w, ln_weight, ln_bias, gamma, beta, eps, rows_per_w):
+    return torch.empty_like(x)
+
+
+if triton is not None:
+    @triton.jit
+    def _modulated_layer_norm_kernel(
+        X, W, Y, LN_W, LN_B, GAMMA, BETA,
+        stride_x, stride_w, stride_y,
+        rows_per_w, C, eps,
+        BLOCK_SIZE: tl.constexpr,
+    ):
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK_SIZE)
+        mask = cols < C
+
+        # One read of the row, statistics in fp32, modulation applied before
+        # the single write.
+        x = tl.load(X + row * stride_x + cols, mask=mask, other=0.).to(tl.float32)
+        mean = tl.sum(x, axis=0) / C
+        xc = tl.where(mask, x - mean, 0.)
+        var = tl.sum(xc * xc, axis=0) / C
+        rstd = 1 / tl.sqrt(var + eps)
+
+        ln_w = tl.load(LN_W + cols, mask=mask, other=0.).to(tl.float32)
+        ln_b = tl.load(LN_B + cols, mask=mask, other=0.).to(tl.float32)
+        w = tl.load(W + (row // rows_per_w) * stride_w + cols, mask=mask,
+            other=0.).to(tl.float32)
+        gamma = tl.load(GAMMA).to(tl.float32)
+        beta = tl.load(BETA).to(tl.float32)
+
+        y = w * (gamma * (xc * rstd * ln_w + ln_b) + beta)
+        tl.store(Y + row * stride_y + cols, y.to(Y.dtype.element_ty), mask=mask)
+
+    @_modulated_layer_norm.register_kernel("cuda")
+    def _(x, w, ln_weight, ln_bias, gamma, beta, eps, rows_per_w):
+        N, C = x.shape
+        y = torch.empty_like(x)
+        BLOCK_SIZE = triton.next_power_of_2(C)
+        num_warps = min(max(BLOCK_SIZE // 256, 1), 8)
+        _modulated_layer_norm_kernel[(N,)](
+            x, w, y, ln_weight, ln_bias, gamma, beta,
+            x.stride(0), w.stride(0), y.stride(0),
+            rows_per_w, C, eps,
+            BLOCK_SIZE=BLOCK_SIZE, num_warps=num_warps,
+        )
+        return y
+
+
+def can_fuse(*tensors):
+    '''
+    The fused kernel is forward-only, so it is used for CUDA inference and
+    everything else goes through the regular autograd path.
+    '''
+    if triton is None or not tensors[0].is_cuda:
+        return False
+    return not (torch.is_grad_enabled() and any(t.requires_grad for t in tensors))
+
+
+def modulated_layer_norm(x, w, ln_weight, ln_bias, gamma, beta, eps):
+    '''
+    Fused `gamma * w * layer_norm(x) + beta * w` over the last dim of
+    channels-last x [B, H, W, C]. w is either [B, H, W, C] or broadcast from
+    [B, 1, 1, C].
+    '''
+    B, H, W_, C = x.shape
+    if all(w.size(d) == 1 or w.stride(d) == 0 for d in (1, 2)):
+        w_rows, rows_per_w = w[:, 0, 0, :].contiguous(), H * W_
+    else:
+        w_rows, rows_per_w = w.expand(B, H, W_, C).reshape(-1, C).contiguous(), 1
+    y = _modulated_layer_norm(
+        x.reshape(-1, C).contiguous(), w_rows.to(x.dtype),
+        ln_weight, ln_bias, gamma.reshape(1), beta.reshape(1), eps, rows_per_w,
+    )
+    return y.view(B, H, W_, C)
@@ -2,8 +2,10 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from attention import SpatialTransformer
+from fused_norm import can_fuse, modulated_layer_norm
 
 
 class ModulatedLayerNorm(nn.Module):
@@ -24,11 +26,22 @@ class ModulatedLayerNorm(nn.Module):
         x,
         w=None,
     ):
-        x = x.permute(0, 2, 3, 1) if self.channels_first else x
+        if self.channels_first:
+            # For channels_last inputs this is a stride-only view, not a copy.
+            x = x.permute(0, 2, 3, 1)
+            w = w.permute(0, 2, 3, 1) if w is not None else None
         if w is None:
             x = self.ln(x)
+        elif can_fuse(x, w, self.ln.weight, self.gamma):
+            x = modulated_layer_norm(
+                x, w, self.ln.weight, self.ln.bias, self.gamma, self.beta, self.ln.eps
+            )
         else:
-            x = self.gamma * w * self.ln(x) + self.beta * w
+            # Normalize in fp32 and modulate in the activation dtype, so
+            # reduced-precision activations keep fp32 statistics.
+            x_dtype = x.dtype
+            x = self.ln(x.float()).to(x_dtype)
+            x = self.gamma.to(x_dtype) * w * x + self.beta.to(x_dtype) * w
         x = x.permute(0, 3, 1, 2) if self.channels_first else x
         return x
 
@@ -43,10 +56,11 @@ class ResBlock(nn.Module):
         scaler=None,
         layer_scale_init_value=1e-6,
         c_cond_override=False,
+        depthwise_compile=False,
     ):
         super().__init__()
-        self.depthwise = nn.Sequential(
-            nn.ReflectionPad2d(1), nn.Conv2d(c, c, kernel_size=3, groups=c)
+        self.depthwise = nn.Conv2d(
+            c, c, kernel_size=3, padding=1, padding_mode="reflect", groups=c
         )
         self.ln = ModulatedLayerNorm(c, channels_first=False)
         if c_cond_override is False:
@@ -74,24 +88,47 @@ class ResBlock(nn.Module):
         # if c_cond_override is not None:
         #     self.cond_mapper = nn.Linear(c_cond_override, c)
 
+        if depthwise_compile:
+            # Let Inductor fuse depthwise conv, norm and channelwise MLP
+            # instead of going through the slow cuDNN depthwise kernels.
+            self.forward = torch.compile(self.forward)
+
+    def _load_from_state_dict(
+        self,
+        state_dict,
+        prefix,
+        *args,
+        **kwargs,
+    ):
+        # Older checkpoints stored the depthwise conv as depthwise.1 after a
+        # separate ReflectionPad2d.
+        for name in ("weight", "bias"):
+            old_key = f"{prefix}depthwise.1.{name}"
+            if old_key in state_dict:
+                state_dict[f"{prefix}depthwise.{name}"] = state_dict.pop(old_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(
         self,
         x,
         s=None,
         skip=None,
     ):
+        # Activations are channels_last, so the NHWC permutes below are views
+        # and LayerNorm/Linear run directly on the underlying memory.
         res = x
-        x = self.depthwise(x)
+        x = self.depthwise(x).permute(0, 2, 3, 1)
         if s is not None:
-            if s.size(2) == s.size(3) == 1:
-                s = s.expand(-1, -1, x.size(2), x.size(3))
-            elif s.size(2) != x.size(2) or s.size(3) != x.size(3):
-                s = nn.functional.interpolate(s, size=x.shape[-2:], mode="bilinear")
+            # Map the conditioning before broadcasting it so the projection
+            # runs once per sample instead of once per pixel.
             s = self.cond_mapper(s.permute(0, 2, 3, 1))
-            # s = self.cond_mapper(s.permute(0, 2, 3, 1))
-            # if s.size(1) == s.size(2) == 1:
-            #     s = s.expand(-1, x.size(2), x.size(3), -1)
-        x = self.ln(x.permute(0, 2, 3, 1), s)
+            if s.size(1) == s.size(2) == 1:
+                s = s.expand(-1, x.size(1), x.size(2), -1)
+            elif s.size(1) != x.size(1) or s.size(2) != x.size(2):
+                s = nn.functional.interpolate(
+                    s.permute(0, 3, 1, 2), size=x.shape[1:3], mode="bilinear"
+                ).permute(0, 2, 3, 1)
+        x = self.ln(x, s)
         if skip is not None:
             x = torch.cat([x, skip.permute(0, 2, 3, 1)], dim=-1)
         x = self.channelwise(x)
@@ -115,10 +152,21 @@ class DenoiseUNet(nn.Module):
         num_heads=8,
         transformer_depth=1,
         context_dim=2048,
+        compile_model=False,
+        compile_mode="reduce-overhead",
+        depthwise_compile=False,
     ):
         super().__init__()
         self.num_labels = num_labels
         self.c_r = c_r
+        self.gradient_checkpointing = False
+        half_dim = c_r // 2
+        r_freq = torch.arange(half_dim).float().mul(
+            -math.log(10000) / (half_dim - 1)
+        ).exp()
+        self.register_buffer("r_freq", r_freq, persistent=False)
+        # Odd c_r leaves one zero-padded channel after the sin/cos halves.
+        self.r_pad = c_r % 2
         self.down_levels = down_levels
         self.up_levels = up_levels
         c_levels = [c_hidden // (2**i) for i in reversed(range(len(down_levels)))]
@@ -146,6 +194,7 @@ class DenoiseUNet(nn.Module):
                     c_levels[i],
                     c_levels[i] * 4,
                     c_clip + c_r,
+                    depthwise_compile=depthwise_compile,
                 )
                 block.channelwise[-1].weight.data *= np.sqrt(1 / sum(down_levels))
                 blocks.append(block)
@@ -187,6 +236,7 @@ class DenoiseUNet(nn.Module):
                         (c_clip + c_r), # * 2,
                         c_levels_up[i] if (j == 0 and i > 0) else 0,
                         c_cond_override= False,#i == len(up_levels) - 1 and j == 0,
+                        depthwise_compile=depthwise_compile,
                     )
                     block.channelwise[-1].weight.data *= np.sqrt(1 / sum(c_levels_up))
                     blocks.append(block)
@@ -204,6 +254,44 @@ class DenoiseUNet(nn.Module):
 
         self.clf = nn.Conv2d(c_levels[0], num_labels, kernel_size=1)
 
+        # Block dispatch is resolved once here instead of isinstance checks on
+        # every forward: 0 = ResBlock, 1 = ResBlock taking the level's skip
+        # connection, 2 = SpatialTransformer, 3 = any other module.
+        self._down_schedule = [
+            [(self._block_opcode(block, False), block) for block in blocks]
+            for blocks in self.down_blocks
+        ]
+        self._up_schedule = [
+            [
+                (self._block_opcode(block, i > 0 and j == 0), block)
+                for j, block in enumerate(blocks)
+            ]
+            for i, blocks in enumerate(self.up_blocks)
+        ]
+
+        # Keep conv weights NHWC so cuDNN can pick Tensor Core kernels without
+        # transposing activations between blocks.
+        self.to(memory_format=torch.channels_last)
+
+        # Compiled forward used by the sampler; shapes are fixed across
+        # sampling steps so a static graph (and CUDA graphs) can be reused.
+        self._compiled = (
+            torch.compile(self.forward, mode=compile_mode, dynamic=False)
+            if compile_model
+            else None
+        )
+
+    @staticmethod
+    def _block_opcode(
+        block,
+        skip,
+    ):
+        if isinstance(block, ResBlock):
+            return 1 if skip else 0
+        if isinstance(block, SpatialTransformer):
+            return 2
+        return 3
+
     def gamma(
         self,
         r,
@@ -215,16 +303,22 @@ class DenoiseUNet(nn.Module):
         x,
         r,
         random_x=None,
+        random_x_buf=None,
+        mask_buf=None,
     ):
+        # random_x_buf / mask_buf are optional preallocated tensors shaped like
+        # x, refilled in place so repeated calls do not allocate new noise.
         r = self.gamma(r)[:, None, None]
-        mask = torch.bernoulli(
-            r * torch.ones_like(x),
-        )
-        mask = mask.round().long()
-        if random_x is None:
+        if mask_buf is None:
+            mask = torch.rand_like(x, dtype=torch.float32) < r
+        else:
+            mask = mask_buf.uniform_() < r
+        if random_x is None and random_x_buf is None:
             random_x = torch.randint_like(x, 0, self.num_labels)
-        x = x * (1 - mask) + random_x * mask
-        return x, mask
+        elif random_x is None:
+            random_x = random_x_buf.random_(0, self.num_labels)
+        x = torch.where(mask, random_x, x)
+        return x, mask.long()
 
     def gen_r_embedding(
         self,
@@ -233,15 +327,22 @@ class DenoiseUNet(nn.Module):
     ):
         dtype = r.dtype
         r = self.gamma(r) * max_positions
-        half_dim = self.c_r // 2
-        emb = math.log(max_positions) / (half_dim - 1)
-        emb = torch.arange(half_dim, device=r.device).float().mul(-emb).exp()
-        emb = r[:, None] * emb[None, :]
+        emb = r[:, None] * self.r_freq[None, :]
         emb = torch.cat([emb.sin(), emb.cos()], dim=1)
-        if self.c_r % 2 == 1:  # zero pad
-            emb = nn.functional.pad(emb, (0, 1), mode="constant")
+        if self.r_pad:  # zero pad
+            emb = nn.functional.pad(emb, (0, self.r_pad), mode="constant")
         return emb.to(dtype)
 
+    def _res_block(
+        self,
+        block,
+        *args,
+    ):
+        # Recompute ResBlock activations on backward instead of storing them.
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(block, *args, use_reentrant=False)
+        return block(*args)
+
     def _down_encode_(
         self,
         x,
@@ -249,14 +350,8 @@ class DenoiseUNet(nn.Module):
         c_full,
     ):
         level_outputs = []
-        for i, blocks in enumerate(self.down_blocks):
-            for j, block in enumerate(blocks):
-                if isinstance(block, ResBlock):
-                    x = block(x, s)
-                elif isinstance(block, SpatialTransformer):
-                    x = block(x, c_full)
-                else:
-                    x = block(x)
+        for schedule in self._down_schedule:
+            x = self._run_schedule(schedule, x, s, c_full)
             level_outputs.insert(0, x)
         return level_outputs
 
@@ -267,21 +362,27 @@ class DenoiseUNet(nn.Module):
         c_full,
     ):
         x = level_outputs[0]
-        for i, blocks in enumerate(self.up_blocks):
-            for j, block in enumerate(blocks):
-                if isinstance(block, ResBlock):
-                    if i > 0 and j == 0:
-                        x = block(x, s, level_outputs[i])
-                    else:
-                        x = block(x, s)
-                elif isinstance(block, SpatialTransformer):
-                    x = block(x, c_full)
-                else:
-                    if i == 1 and j == 0:
-                        x_perm = x
-                        x = block(x_perm)
-                    else:
-                        x = block(x)
+        for i, schedule in enumerate(self._up_schedule):
+            x = self._run_schedule(schedule, x, s, c_full, level_outputs[i])
+        return x
+
+    def _run_schedule(
+        self,
+        schedule,
+        x,
+        s,
+        c_full,
+        skip=None,
+    ):
+        for op, block in schedule:
+            if op == 0:
+                x = self._res_block(block, x, s)
+            elif op == 1:
+                x = self._res_block(block, x, s, skip)
+            elif op == 2:
+                x = block(x, c_full)
+            else:
+                x = block(x)
         return x
 
     def forward(
@@ -293,6 +394,7 @@ class DenoiseUNet(nn.Module):
     ):  # r is a uniform value between 0 and 1
         r_embed = self.gen_r_embedding(r)
         x = self.embedding(x).permute(0, 3, 1, 2)
+        x = x.contiguous(memory_format=torch.channels_last)
         if len(c.shape) == 2:
             s = torch.cat([c, r_embed], dim=-1)[:, :, None, None]
         else:
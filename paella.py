@@ -12,7 +12,7 @@ import torch.multiprocessing as mp
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel
 from modules import DenoiseUNet
-from utils import get_dataloader, sample, encode, decode
+from utils import CudaPrefetcher, get_dataloader, sample, encode, decode
 from t5 import FrozenT5Embedder
 import open_clip
 from open_clip import tokenizer
@@ -78,6 +78,7 @@ def train(proc_id, args):
         torch.set_num_threads(6)
 
     model = DenoiseUNet(num_labels=args.num_codebook_vectors, c_clip=2048).to(device)
+    model.gradient_checkpointing = args.gradient_checkpointing
 
     if not proc_id and args.node_id == 0:
         print(f"Number of Parameters: {sum([p.numel() for p in model.parameters()])}")
@@ -90,7 +91,12 @@ def train(proc_id, args):
     t5_model = FrozenT5Embedder(device=device).to(device)
 
     lr = 3e-4
-    dataset = get_dataloader(args)
+    dataset = CudaPrefetcher(get_dataloader(
+        args,
+        distributed=parallel,
+        rank=proc_id + len(args.devices) * args.node_id,
+        world_size=args.n_nodes * len(args.devices),
+    ), device)
     optimizer = optim.AdamW(model.parameters(), lr=lr)
     criterion = nn.CrossEntropyLoss(label_smoothing=0.1)
 
@@ -141,8 +147,13 @@ def train(proc_id, args):
 
     if parallel:
         model = DistributedDataParallel(
-            model, device_ids=[device], output_device=device
+            model,
+            device_ids=[device],
+            output_device=device,
+            broadcast_buffers=False,
+            gradient_as_bucket_view=True,
         )
+    unet = model.module if parallel else model
 
     # pbar = tqdm(
     #     enumerate(dataset, start=start_step),
@@ -168,11 +179,11 @@ def train(proc_id, args):
 
             traceback.print_exc()
             continue
-        images = images.to(device)
+        images = images.float().div_(255.0)
         with torch.no_grad():
             image_indices = encode(vqmodel, images)
             r = torch.rand(images.size(0), device=device)
-            noised_indices, mask = model.add_noise(image_indices, r)
+            noised_indices, mask = unet.add_noise(image_indices, r)
 
             if (
                 np.random.rand() < 0.1
@@ -234,7 +245,7 @@ def train(proc_id, args):
                 image_indices = image_indices[:10]
                 captions = captions[:10]
                 text_embeddings = text_embeddings[:10]
-                sampled = sample(model, c=text_embeddings,
+                sampled = sample(unet, c=text_embeddings,
                     c_full=text_embeddings_full)  # [-1]
                 sampled = decode(vqmodel, sampled)
                 recon_images = decode(vqmodel, image_indices)
@@ -273,7 +284,7 @@ def train(proc_id, args):
                     st = time.time()
                     for caption_embedding in cool_captions:
                         caption_embedding = caption_embedding[0].float().to(device)
-                        sampled_text = sample(model, c=caption_embedding,
+                        sampled_text = sample(unet, c=caption_embedding,
                             c_full=cool_captions_embeddings_full)  # [-1]
                         sampled_text = decode(vqmodel, sampled_text)
                         # sampled_text_ema = decode(vqmodel, sampled_text_ema)
@@ -386,6 +397,7 @@ if __name__ == "__main__":
     args.num_codebook_vectors = 8192
     args.log_captions = True
     args.finetune = False
+    args.gradient_checkpointing = False
 
     args.n_nodes = 1
     args.node_id = 0  # int(os.environ["SLURM_PROCID"])
@@ -40,7 +40,7 @@ del clip_model.visual
 clip_model = clip_model.to('cpu').eval().requires_grad_(False)
 t5_model = FrozenT5Embedder(device='cpu').to('cpu')
 
-model = DenoiseUNet(8192, c_clip=2048)
+model = DenoiseUNet(8192, c_clip=2048, compile_model=True)
 model.load_state_dict(
     torch.load('pytorch_model.bin', map_location='cuda')
 )
@@ -1,9 +1,9 @@
+import contextlib
 import torch
-import torchvision
+from torchvision.transforms import v2
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader
-from random import randrange
 import numpy as np
-import PIL
 from PIL import Image
 from io import BytesIO
 import math
@@ -11,36 +11,6 @@ from einops import rearrange
 
 TARGET_SIZE = 256
 
-def resize_image(img):
-    width, height = img.size   # Get dimensions
-
-    rz_w = width
-    rz_h = height
-    _m = max(width, height)
-    if _m == width:
-        rz_h = TARGET_SIZE
-        rz_w = math.floor((rz_w / rz_h) * TARGET_SIZE)
-    if _m == height:
-        rz_h = math.floor((rz_h / rz_w) * TARGET_SIZE)
-        rz_w = TARGET_SIZE
-    
-    img = img.resize((rz_w, rz_h), resample=PIL.Image.LANCZOS)
-
-    return img
-
-
-def crop_random(img):
-    img_size = img.size
-    x_max = img_size[0] - TARGET_SIZE
-    y_max = img_size[1] - TARGET_SIZE
-
-    random_x = randrange(0, x_max//2 + 1) * 2
-    random_y = randrange(0, y_max//2 + 1) * 2
-
-    area = (random_x, random_y, random_x + TARGET_SIZE, random_y + TARGET_SIZE)
-    c_img = img.crop(area)
-    return c_img
-
 
 def encode(vq, x):
     return vq.model.encode((2 * x - 1))[-1][-1]
@@ -76,6 +46,66 @@ def gumbel_sample(t, temperature=1., dim=-1):
     return ((t / max(temperature, 1e-10)) + gumbel_noise(t)).argmax(dim=dim)
 
 
+def typical_cost(x_flat):
+    x_flat_norm = torch.nn.functional.log_softmax(x_flat, dim=-1)
+    entropy = -(x_flat_norm * x_flat_norm.exp()).nansum(-1, keepdim=True)
+    return x_flat_norm, torch.abs((-x_flat_norm) - entropy)
+
+
+# Fused by Inductor into one kernel; only used when compilation is opted into.
+compiled_typical_cost = torch.compile(typical_cost, fullgraph=True)
+
+
+def typical_threshold(x_flat_norm, c_flat_shifted, log_mass, typical_min_tokens,
+        k=None):
+    '''
+    Shifted cost of the last token kept by typical filtering, searched among
+    the k most typical tokens (all of them when k is None), and whether
+    those tokens reach the mass at all.
+    '''
+    if k is None:
+        c_flat_sorted, x_flat_indices = torch.sort(c_flat_shifted, descending=False)
+    else:
+        c_flat_sorted, x_flat_indices = torch.topk(
+            c_flat_shifted, k, dim=-1, largest=False, sorted=True)
+    # Cumulative probability in sorted order, kept in log space so the
+    # log-probs are reused instead of taking a second softmax.
+    x_flat_cumsum = x_flat_norm.gather(-1, x_flat_indices).logcumsumexp(dim=-1)
+
+    reached = x_flat_cumsum[:, -1] >= log_mass
+    last_ind = (x_flat_cumsum < log_mass).sum(dim=-1)
+    last_ind = last_ind.clamp(typical_min_tokens - 1, c_flat_sorted.size(-1) - 1)
+    return c_flat_sorted.gather(1, last_ind.view(-1, 1)), reached
+
+
+def typical_filter(x_flat, typical_mass, typical_min_tokens, topk=None,
+        compiled=False):
+    cost_fn = compiled_typical_cost if compiled else typical_cost
+    x_flat_norm, c_flat_shifted = cost_fn(x_flat)
+    log_mass = math.log(typical_mass)
+
+    # Only the most typical tokens up to the cutoff matter, so select them
+    # with topk instead of sorting the whole vocabulary. By default k leaves
+    # 4x headroom over a uniform distribution's kept set.
+    vocab_size = x_flat.size(-1)
+    if topk is None:
+        topk = math.ceil(4 * typical_mass * vocab_size)
+    k = min(max(topk, typical_min_tokens), vocab_size)
+    threshold, reached = typical_threshold(x_flat_norm, c_flat_shifted,
+        log_mass, typical_min_tokens, k=k if k < vocab_size else None)
+    if k < vocab_size and not reached.all():
+        # Rare: some rows keep more than k tokens. Sort the whole batch once
+        # and take only those rows' thresholds from it.
+        threshold_full, _ = typical_threshold(x_flat_norm, c_flat_shifted,
+            log_mass, typical_min_tokens)
+        threshold = torch.where(reached[:, None], threshold, threshold_full)
+
+    # Tokens past the cutoff in sorted order are exactly those whose shifted
+    # cost exceeds the cutoff's, so mask by threshold rather than scattering
+    # a sorted mask back.
+    return x_flat.masked_fill(c_flat_shifted > threshold, -float("Inf"))
+
+
 def sample(
     model,
     c,
@@ -94,8 +124,38 @@ def sample(
     c_full=None,
     c_uncond=None,
     c_full_uncond=None,
+    checkpoint_sampling=False,
+    autocast_dtype=torch.bfloat16,
+    compile_typical=None,
 ):
-    with torch.inference_mode():
+    compiled = getattr(model, '_compiled', None)
+    # Compile the typical-filtering helper only alongside a compiled model
+    # unless asked explicitly.
+    if compile_typical is None:
+        compile_typical = compiled is not None
+
+    def denoise(*args):
+        # Only the UNet runs in reduced precision; guidance, typical
+        # filtering and sampling work on fp32 logits.
+        with torch.autocast(device_type=args[0].device.type,
+                dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            return _denoise(*args).float()
+
+    def _denoise(*args):
+        if checkpoint_sampling:
+            # Keep only the step inputs; UNet activations are recomputed on
+            # backward so gradients can flow through all T steps.
+            return checkpoint(model, *args, use_reentrant=False)
+        if compiled is None:
+            return model(*args)
+        # CUDA graph replays reuse their output buffers, so copy the logits
+        # out before the next call.
+        torch.compiler.cudagraph_mark_step_begin()
+        return compiled(*args).clone()
+
+    grad_context = contextlib.nullcontext() if checkpoint_sampling \
+        else torch.inference_mode()
+    with grad_context:
         r_range = torch.linspace(0, 1, T+1)[:-1][:, None].expand(-1, c.size(0)).to(c.device)
         temperatures = torch.linspace(temp_range[0], temp_range[1], T)
         if x is None:
@@ -104,9 +164,13 @@ def sample(
             noise = torch.randint(0, model.num_labels, size=(c.size(0), *size), device=c.device)
             x = noise * mask + (1-mask) * x
         init_x = x.clone()
+        # Reused across steps so renoising does not allocate every iteration.
+        mask_buf = torch.empty(x.shape, dtype=torch.float32, device=x.device)
+        random_x_buf = torch.empty_like(x) if renoise_mode not in ('start', 'prev') else None
+        prev_x = torch.empty_like(x) if renoise_mode == 'prev' else None
         for i in range(starting_t, T):
             if renoise_mode == 'prev':
-                prev_x = x.clone()
+                prev_x.copy_(x)
             r, temp = r_range[i], temperatures[i]
 
             lfcu = []
@@ -117,13 +181,20 @@ def sample(
                 c_uncond = torch.zeros_like(c)
                 c_full_uncond = torch.zeros_like(c_full)
 
-                logits_from_c_uncond_00 = model(x, c_uncond, r, c_full_uncond)
-                logits_from_c_uncond_10 = model(x, c, r, c_full_uncond)
-                logits_from_c_uncond_01 = model(x, c_uncond, r, c_full)
+                # Run the three unconditioned passes and the conditioned pass
+                # as a single batch through the UNet.
+                logits_all = denoise(
+                    torch.cat([x, x, x, x], 0),
+                    torch.cat([c_uncond, c, c_uncond, c], 0),
+                    r.repeat(4),
+                    torch.cat([c_full_uncond, c_full_uncond, c_full, c_full], 0),
+                )
+                logits_from_c_uncond_00, logits_from_c_uncond_10, \
+                    logits_from_c_uncond_01, logits = logits_all.chunk(4, 0)
                 lfcu = [logits_from_c_uncond_00, logits_from_c_uncond_10,
                     logits_from_c_uncond_01]
-
-            logits = model(x, c, r, c_full)
+            else:
+                logits = denoise(x, c, r, c_full)
 
             if classifier_free_scale >= 0 and len(lfcu) == 0:
                 print('Warning: you are sampling with classifier free guidance ' +
@@ -144,20 +215,8 @@ def sample(
             x_flat = x.permute(0, 2, 3, 1).reshape(-1, x.size(1))
 
             if typical_filtering:
-                x_flat_norm = torch.nn.functional.log_softmax(x_flat, dim=-1)
-                x_flat_norm_p = torch.exp(x_flat_norm)
-                entropy = -(x_flat_norm * x_flat_norm_p).nansum(-1, keepdim=True)
-
-                c_flat_shifted = torch.abs((-x_flat_norm) - entropy)
-                c_flat_sorted, x_flat_indices = torch.sort(c_flat_shifted, descending=False)
-                x_flat_cumsum = x_flat.gather(-1, x_flat_indices).softmax(dim=-1).cumsum(dim=-1)
-
-                last_ind = (x_flat_cumsum < typical_mass).sum(dim=-1)
-                sorted_indices_to_remove = c_flat_sorted > c_flat_sorted.gather(1, last_ind.view(-1, 1))
-                if typical_min_tokens > 1:
-                    sorted_indices_to_remove[..., :typical_min_tokens] = 0
-                indices_to_remove = sorted_indices_to_remove.scatter(1, x_flat_indices, sorted_indices_to_remove)
-                x_flat = x_flat.masked_fill(indices_to_remove, -float("Inf"))
+                x_flat = typical_filter(x_flat, typical_mass, typical_min_tokens,
+                    compiled=compile_typical)
             # x_flat = torch.multinomial(x_flat.div(temp).softmax(-1), num_samples=1)[:, 0]
             x_flat = gumbel_sample(x_flat, temperature=temp)
             x = x_flat.view(x.size(0), *x.shape[2:])
@@ -165,47 +224,125 @@ def sample(
                 x = x * mask + (1-mask) * init_x
             if i < renoise_steps:
                 if renoise_mode == 'start':
-                    x, _ = model.add_noise(x, r_range[i+1], random_x=init_x)
+                    x, _ = model.add_noise(x, r_range[i+1], random_x=init_x,
+                        mask_buf=mask_buf)
                 elif renoise_mode == 'prev':
-                    x, _ = model.add_noise(x, r_range[i+1], random_x=prev_x)
+                    x, _ = model.add_noise(x, r_range[i+1], random_x=prev_x,
+                        mask_buf=mask_buf)
                 else:  # 'rand'
-                    x, _ = model.add_noise(x, r_range[i+1])
+                    x, _ = model.add_noise(x, r_range[i+1],
+                        random_x_buf=random_x_buf, mask_buf=mask_buf)
     return x.detach()
 
 
 class ProcessData:
-    def __init__(self, image_size=256):
-        self.transforms = torchvision.transforms.Compose([
-            torchvision.transforms.ToTensor(),
-            torchvision.transforms.Resize(image_size),
-            torchvision.transforms.RandomCrop(image_size),
+    def __init__(self, image_size=TARGET_SIZE):
+        self.image_size = image_size
+        # Images stay uint8 through the CPU pipeline; conversion to float
+        # happens on the GPU after the batch has been transferred.
+        self.transforms = v2.Compose([
+            v2.Resize(image_size, antialias=True),
+            v2.RandomCrop(image_size),
+            v2.PILToTensor(),
         ])
 
+    def image(self, img):
+        # Decode JPEGs at reduced scale while keeping 2x headroom over the
+        # resized shorter side.
+        scale = 2 * self.image_size / min(img.size)
+        img.draft('RGB', (math.ceil(img.size[0] * scale),
+            math.ceil(img.size[1] * scale)))
+        return self.transforms(img.convert('RGB'))
+
     def __call__(self, data):
-        data["jpg"] = self.transforms(data["jpg"])
+        data["jpg"] = self.image(data["jpg"])
         return data
 
 
-def preprocess(image):
-    w, h = image.size
-    w, h = map(lambda x: x - x % 32, (w, h))  # resize to integer multiple of 32
-    image = image.resize((w, h), resample=PIL.Image.LANCZOS)
-    image = np.array(image).astype(np.float32) / 255.0
-    image = image[None].transpose(0, 3, 1, 2)
-    image = torch.from_numpy(image)
-    return image
+process_data = ProcessData(TARGET_SIZE)
+
+
+def open_image(value):
+    '''
+    Lazily open an undecoded `datasets` Image value ({'bytes', 'path'}), so
+    that JPEG draft decoding can still take effect.
+    '''
+    if value.get('bytes') is not None:
+        return Image.open(BytesIO(value['bytes']))
+    return Image.open(value['path'])
 
 
 def collate(batch):
-    images = torch.cat([preprocess(crop_random(resize_image(i['1600px']))) for i in batch], 0)
+    # Decode straight into one preallocated uint8 batch; the training loop
+    # scales it to [0, 1] on the GPU.
+    images = torch.empty((len(batch), 3, TARGET_SIZE, TARGET_SIZE),
+        dtype=torch.uint8)
+    for idx, item in enumerate(batch):
+        images[idx] = process_data.image(open_image(item['1600px']))
     captions = [i['image_alt'] if i.get('image_alt', None) is not None else
         i.get('image_caption', '') for i in batch]
     return [images, captions]
 
 
-def get_dataloader(args):
+def get_dataloader(args, distributed=False, rank=0, world_size=1):
     import datasets
     dataset = datasets.load_dataset("gigant/oldbookillustrations_2", split="train")
+    # datasets decodes (and fully loads) images by default, which would make
+    # img.draft() a no-op; collate opens the raw bytes instead.
+    dataset = dataset.cast_column("1600px", datasets.Image(decode=False))
+    if distributed:
+        # Each DDP rank iterates over its own disjoint shard.
+        from datasets.distributed import split_dataset_by_node
+        dataset = split_dataset_by_node(dataset, rank=rank, world_size=world_size)
     dataloader = DataLoader(dataset, batch_size=args.batch_size,
-        num_workers=args.num_workers, collate_fn=collate)
+        num_workers=args.num_workers, collate_fn=collate, pin_memory=True)
     return dataloader
+
+
+class CudaPrefetcher:
+    '''
+    Wraps a dataloader and copies the next batch to the GPU on a side stream
+    while the current batch is in use. Non-tensor entries (captions) are
+    passed through unchanged.
+    '''
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self._preload()
+        return self
+
+    def _preload(self):
+        try:
+            batch = next(self.iterator)
+        except Exception as e:
+            # Raised from __next__ once the batches before it are consumed.
+            self.next_batch, self.error = None, e
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = [
+                t.to(self.device, non_blocking=True)
+                if isinstance(t, torch.Tensor) else t
+                for t in batch
+            ]
+
+    def __next__(self):
+        if self.next_batch is None:
+            error = self.error
+            self._preload()
+            raise error
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        for t in batch:
+            if isinstance(t, torch.Tensor):
+                # Memory was allocated on the side stream but is used here.
+                t.record_stream(current_stream)
+        self._preload()
+        return batch